@@ -77,10 +77,7 @@ class Encoder(ABC):
 			texts = [texts]
 		
 		# Encode texts
-		encodings = [
-			self._encode_wrapper(text, min_tokens, max_tokens)
-			for text in texts
-		]
+		encodings = self.generate_encodings(texts, min_tokens, max_tokens)
 
 		# Return single encoding if single text is given
 		if single_text:
@@ -95,6 +92,26 @@ class Encoder(ABC):
 			)
 
 		return encodings
+
+	def generate_encodings(
+		self,
+		texts: list[str],
+		min_tokens: int,
+		max_tokens: int
+	) -> list[list[int]]:
+		'''
+		Encodes a list of (preprocessed) texts without padding them.
+
+		:param list[str] texts: Texts to encode.
+		:param int min_tokens: Min tokens in text encodings.
+		:param int max_tokens: Max tokens in text encodings.
+
+		:returns encodings (list[list[int]]): Text encodings.
+		'''
+		return [
+			self._encode_wrapper(text, min_tokens, max_tokens)
+			for text in texts
+		]
 	
 	@abstractmethod
 	def encode(
@@ -192,7 +192,7 @@ def main() -> None:
 
 	else:
 		print(f'Evaluating pipelines with device {device}...')
-		evaluator = Evaluator(pipelines, device)
+		evaluator = Evaluator(pipelines, device, warmup=model_name != 'gpt')
 		evaluator_results = evaluator(texts, summaries, batch_size)
 		results.update(evaluator_results)
 
@@ -43,6 +43,11 @@ class Pipeline(ABC):
 		**kwargs
 	) -> list[str]: ...
 
+	def offload(self) -> None:
+		'''
+		Removes the model from the device, if it was kept there.
+		'''
+
 
 
 class SummarizationPipeline(Pipeline):
@@ -59,6 +64,9 @@ class SummarizationPipeline(Pipeline):
 	:param float = 1.0 repetition_penalty: The repetition penalty.
 	:param float = 0.9 top_p: The nucleus sampling threshold.
 
+	Pass `keep_on_device=True` when generating to keep the model on the device
+	after generation, and call `offload` to remove it.
+
 	## Returns
 	list[str]: The generated summaries.
 	'''
@@ -102,6 +110,7 @@ class SummarizationPipeline(Pipeline):
 			'repetition_penalty', self.repetition_penalty
 		)
 		top_p = kwargs.get('top_p', self.top_p)
+		keep_on_device = kwargs.get('keep_on_device', False)
 
 		# Generate encodings in batches
 		batches = SummarizationDataset(texts, encoder, batch_size)
@@ -134,7 +143,8 @@ class SummarizationPipeline(Pipeline):
 			all_summaries.extend(summaries)
 
 		# Remove model from device
-		model.to('cpu')
+		if not keep_on_device:
+			model.to('cpu')
 
 		# Postprocess summaries
 		if postprocessor is not None:
@@ -142,6 +152,9 @@ class SummarizationPipeline(Pipeline):
 
 		return all_summaries
 
+	def offload(self) -> None:
+		self.model.to('cpu')
+
 
 
 class OpenAIPipeline(Pipeline):
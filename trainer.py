@@ -44,6 +44,10 @@ def main() -> None:
 	shuffle = args.no_shuffle
 	batch_size = args.batch_size
 	epochs = args.epochs
+	num_workers = args.num_workers
+	precision = args.precision
+	cache_dir = args.cache_dir
+	compile_model = args.compile
 	device = 'cpu' if args.no_gpu else get_device(GPU_USAGE_TOLERANCE)
 
 	# All paths that are needed to be hard coded
@@ -159,10 +163,18 @@ def main() -> None:
 		case _:
 			raise ValueError(f'Invalid encoder name: {encoder_name}')
 
+	# Configuration deciding the encodings, keys the cache of encodings
+	# The cache must be cleared if the preprocessors are changed in this script
+	cache_key = repr((
+		model_name, encoder_name, sent_dir, MIN_TOKEN_FRAC, HEAD_SIZE,
+		SEGMENT_MIN_WORDS, THRESHOLD, PROB_BOOST, NUM_KEYWORDS,
+		EXTRA_STOP_WORDS, SEED
+	))
+
 	print('Initializing dataset...')
 	dataset = SummarizationDataset(
 		texts, encoder, batch_size, summaries,
-		context_size, shuffle, SEED
+		context_size, shuffle, SEED, cache_dir, cache_key
 	)
 
 	# Adam optimizer with weight decay
@@ -177,7 +189,8 @@ def main() -> None:
 	print(f'Starting training with device {device}...\n')
 	train_history, successful = train_model(
 		model, dataset, epochs, optimizer, scheduler,
-		device, FLT_PREC, SPACES
+		device, FLT_PREC, SPACES, num_workers, precision,
+		compile_model=compile_model
 	)
 
 	if not successful:
@@ -231,6 +244,25 @@ def get_arguments() -> Namespace:
 		'--no-shuffle', action='store_false',
 		help='specify to NOT shuffle data in the dataset'
 	)
+	parser.add_argument(
+		'--num-workers', action='store', type=int, default=0,
+		help='number of processes encoding batches, requires --cache-dir '
+		'(encoders using a GPU need 0)'
+	)
+	parser.add_argument(
+		'--precision', action='store', type=str, default='bf16',
+		choices=['fp32', 'fp16', 'bf16'],
+		help='floating point precision used for training on GPU'
+	)
+	parser.add_argument(
+		'--cache-dir', action='store', type=str,
+		help='directory to cache batch encodings in instead of memory '
+		'(clear it if the preprocessors in this script are changed)'
+	)
+	parser.add_argument(
+		'--compile', action='store_true',
+		help='specify to compile the model (only on GPU)'
+	)
 	parser.add_argument(
 		'--seed', action='store', type=int,
 		help='use a manual seed for output reproducibility'
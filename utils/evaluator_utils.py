@@ -2,11 +2,16 @@
 Contains utilites for `evaluator.py`.
 '''
 
+import os
+from time import perf_counter
+
 import numpy as np
 import torch
 from bert_score import BERTScorer
 from rouge import Rouge
 
+from .helpers import count_tokens
+
 
 
 class Evaluator:
@@ -17,7 +22,8 @@ class Evaluator:
 		device: str | torch.device = 'cpu',
 		rouge_metrics: list[str] | None = None,
 		rougen_max_n: int = 2,
-		rougew_weight_factor: int = 1.2
+		rougew_weight_factor: int = 1.2,
+		warmup: bool = True
 	) -> None:
 
 		# Initialize pipelines
@@ -26,7 +32,13 @@ class Evaluator:
 		self.num_pipelines = len(pipelines)
 
 		# Initialize BERT scorer
-		self.bert_scorer = BERTScorer(lang='en', device=device)
+		self.bert_scorer = BERTScorer(
+			lang = 'en',
+			device = device,
+			batch_size = 128,
+			nthreads = os.cpu_count(),
+			use_fast_tokenizer = True
+		)
 		self.device = device
 
 		# Initialise ROUGE scorer
@@ -47,7 +59,9 @@ class Evaluator:
 		self.rougen_max_n = rougen_max_n
 		self.rougew_weight_factor = rougew_weight_factor
 
+		self.warmup = warmup
 		self.summaries = None
+		self.times = None
 
 	def __call__(
 		self,
@@ -61,7 +75,8 @@ class Evaluator:
 		rouge_score = self.get_rouge_score(summaries)
 		scores = {
 			'bert-scores': bert_score,
-			'rouge-scores': rouge_score
+			'rouge-scores': rouge_score,
+			'generation-times': self.times
 		}
 		return scores
 
@@ -74,9 +89,28 @@ class Evaluator:
 		if isinstance(texts, str):
 			texts = [texts]
 		all_summaries = self.summaries = []
+		times = self.times = []
 		for i, pipeline in enumerate(self.pipelines):
+
+			# Warm up pipeline to exclude one-time costs from timing
+			# The model is kept on the device, so that moving it there is
+			# not timed either
+			if self.warmup:
+				with torch.inference_mode():
+					pipeline('Warmup.', keep_on_device=True)
+
+			# Time generation and count tokens generated
 			print(f'Generating summaries for pipeline {i + 1}...')
-			summaries = pipeline(texts, batch_size=batch_size)
+			start = perf_counter()
+			with torch.inference_mode():
+				summaries = pipeline(
+					texts, batch_size=batch_size, keep_on_device=True
+				)
+			time_taken = (perf_counter() - start) * 1000
+			pipeline.offload()
+			num_tokens, _ = count_tokens(summaries, pipeline.encoder.tokenizer)
+			times.append((time_taken, num_tokens))
+
 			all_summaries.extend(summaries)
 	
 	# P, R, F
@@ -85,19 +119,26 @@ class Evaluator:
 		summaries: list[str]
 	) -> list[list[float]]:
 
-		all_summaries = self.summaries
-		assert all_summaries is not None, 'Summaries not generated'
-		num_pipelines = self.num_pipelines
-		summaries = num_pipelines * summaries
-		metrics = self.bert_scorer.score(all_summaries, summaries)
-		metrics = np.array([
-			metric.reshape((num_pipelines, -1)).mean(dim=1)
-			for metric in metrics
-		])
-		order = [2, 0, 1]
-		metrics *= 100
-		metrics = metrics.T[:, order].tolist()
-		return metrics
+		generated_summaries = self.summaries
+		assert generated_summaries is not None, 'Summaries not generated'
+		num_generated_summaries = len(generated_summaries)
+		num_summaries = len(summaries)
+		use_amp = torch.device(self.device).type == 'cuda'
+		scores = []
+		for i in range(0, num_generated_summaries, num_summaries):
+			pipeline_summaries = generated_summaries[i:i+num_summaries]
+
+			# Score in half precision on GPU
+			with torch.inference_mode(), torch.autocast(
+				'cuda', dtype=torch.float16, enabled=use_amp
+			):
+				metrics = self.bert_scorer.score(pipeline_summaries, summaries)
+			precision, recall, f1 = [
+				metric.float().mean().item() * 100
+				for metric in metrics
+			]
+			scores.append([f1, precision, recall])
+		return scores
 	
 	# F, P, R
 	def get_rouge_score(
@@ -59,10 +59,12 @@ def get_stop_words(
 
 class TextProcessor:
 
+	# Patterns are compiled once and shared by all instances
+
 	# Matches everything except words, numbers, and single quotes
-	_non_word_pat_sub = (r"[^\w\s']", '')
+	_non_word_pat_sub = (re.compile(r"[^\w\s']"), '')
 
-	_preprocessing_pats_subs = [
+	_preprocessing_pats_subs = tuple((re.compile(pat), sub) for pat, sub in (
 		# Remove hyperlinks
 		(r'https?://[^\s]+', ''),
 		# Remove unecessary periods
@@ -85,20 +87,19 @@ class TextProcessor:
 		(r'\(([^\)]*)\)', lambda m: f'({m.group(1).strip()})'),
 		# Join broken sentences
 		(r'(\w[,;]?)\s+(\w)', r'\1 \2'),
-	]
+	))
 
 	# Remove numbers
-	_number_pat_sub = (r'(\b|\+)[\d+-]+\b', '')
-
-	# White spaces
-	_whitespace_pats_subs = [
-		# Replace multiple spaces and tabs
-		(r'[ \t]+', ' '),
-		# Remove spaces around newline
-		(r' ?\n ?', '\n'),
-		# Replace multiple newlines
-		(r'\n{3,}', '\n\n'),
-	]
+	_number_pat_sub = (re.compile(r'(\b|\+)[\d+-]+\b'), '')
+
+	# White spaces, fixed in a single pass
+	# Runs of spaces and tabs are replaced by a space, spaces around newlines
+	# are removed and runs of more than two newlines are replaced by two
+	# Single spaces are not matched, as they are left unchanged
+	_whitespace_pat_sub = (
+		re.compile(r'[ \t]*\n[ \t\n]*| [ \t]+|\t[ \t]*'),
+		lambda m: '\n' * min(m.group().count('\n'), 2) or ' '
+	)
 
 	def __init__(
 		self,
@@ -127,11 +128,9 @@ class TextProcessor:
 			pats_subs.append((re.compile(r'|'.join(ignore_tokens)), ''))
 
 		# Fix white spaces
-		pats_subs.extend(TextProcessor._whitespace_pats_subs)
+		pats_subs.append(TextProcessor._whitespace_pat_sub)
 
-		self._pats_subs = [
-			(re.compile(pat), sub) for pat, sub in pats_subs
-		]
+		self._pats_subs = tuple(pats_subs)
 	
 	def __call__(
 		self,
@@ -144,9 +143,10 @@ class TextProcessor:
 			texts = [texts]
 		
 		# Process texts
+		pats_subs = self._pats_subs
 		processed_texts = []
 		for text in texts:
-			for pat, sub in self._pats_subs:
+			for pat, sub in pats_subs:
 				text = pat.sub(sub, text)
 			text = text.strip()
 			processed_texts.append(text)
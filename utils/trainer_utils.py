@@ -2,18 +2,22 @@
 Contains utilities for `trainer.py`.
 '''
 
+import os
 import math
+import hashlib
 import time
+import random
 
 import numpy as np
 import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
 from transformers.tokenization_utils_base import BatchEncoding
 
-from utils.helpers import count_words, show_exception, clear_stdout
+from utils.helpers import show_exception, clear_stdout
 
 
 
-class SummarizationDataset:
+class SummarizationDataset(Dataset):
 	'''
 	Creates an iterable batched dataset of text (and summary) encodings.
 
@@ -25,6 +29,12 @@ class SummarizationDataset:
 	`summary_max_tokens`: Maximum tokens in summary encodings
 	`shuffle`: Shuffle batches before iterating
 	`seed`: Manual seed for output reproducibility
+	`cache_dir`: Directory to cache batch encodings in instead of memory,
+	reused only by datasets with the same texts, summaries, batch size, seed,
+	and `cache_key`
+	`cache_key`: Description of the encoder configuration (preprocessor,
+	segmenter, and encoder parameters) keying the cache, the cache must be
+	cleared if configuration not described here changes
 	'''
 
 	def __init__(
@@ -35,7 +45,9 @@ class SummarizationDataset:
 		summaries: list[str] | None = None,
 		summary_max_tokens: int = 0,
 		shuffle: bool = False,
-		seed: int | None = None
+		seed: int | None = None,
+		cache_dir: str | None = None,
+		cache_key: str = ''
 	) -> None:
 
 		# Check if texts and summaries are of same length
@@ -45,34 +57,69 @@ class SummarizationDataset:
 				'Length of texts and summaries must be equal'
 
 		# This enables dynamic batching
-		perm = np.argsort([count_words(text) for text in texts])
-		texts = np.array(texts)[perm]
+		# Texts are sorted by their number of tokens, which matches the
+		# padding in batches better than the number of words
+		# All texts and summaries are tokenized here (and hashed if caching on
+		# disk), hence the first batch is delayed in proportion to the corpus
+		lengths = np.array(encoder.tokenizer(
+			texts, add_special_tokens=False, return_attention_mask=False,
+			return_length=True, verbose=False
+		)['length'], dtype=np.int32)
+		perm = np.argsort(lengths, kind='stable')
+		texts = [texts[i] for i in perm]
+
+		# Tokenize all summaries at once, they are padded when batches are
+		# created
 		if summaries is not None:
-			summaries = np.array(summaries)[perm]
+			summaries = [summaries[i] for i in perm]
+			summaries = encoder.tokenizer(
+				summaries, max_length=summary_max_tokens, truncation=True
+			)['input_ids']
 
-		# Store batches of texts and summaries in a numpy array
+		# Store batches of texts and summary encodings
 		num_batches = self.num_batches = math.ceil(len(texts) / batch_size)
-		self.text_batches = np.zeros(num_batches, dtype=object)
-		self.summary_batches = None if summaries is None \
-			else np.zeros(num_batches, dtype=object)
-		for i in range(self.num_batches):
-			text_batch = texts[i*batch_size:(i+1)*batch_size].tolist()
-			self.text_batches[i] = text_batch
+		self.text_batches = [
+			texts[i*batch_size:(i+1)*batch_size]
+			for i in range(num_batches)
+		]
+		self.summary_batches = None if summaries is None else [
+			summaries[i*batch_size:(i+1)*batch_size]
+			for i in range(num_batches)
+		]
+
+		# Cache batch encodings in memory or on disk
+		# Disk caches are stored under a fingerprint of the dataset and the
+		# given cache key, so that encodings of a different dataset or
+		# encoder configuration are never loaded
+		self.cache = [None] * num_batches
+		if cache_dir is not None:
+			fingerprint = hashlib.sha256(repr((
+				cache_key, type(encoder).__name__,
+				encoder.tokenizer.name_or_path, encoder.min_tokens,
+				encoder.max_tokens, encoder.add_special_tokens, encoder.bos_id,
+				encoder.eos_id, batch_size, summary_max_tokens, num_batches, seed
+			)).encode())
+			for text in texts:
+				fingerprint.update(text.encode())
+				fingerprint.update(b'\x00')
 			if summaries is not None:
-				summary_batch = summaries[i*batch_size:(i+1)*batch_size].tolist()
-				self.summary_batches[i] = summary_batch
-
-		# Use numpy array as a cache, if specified
-		self.cache = np.zeros(
-			self.num_batches, dtype=object
-		)
-
+				for encoding in summaries:
+					fingerprint.update(repr(encoding).encode())
+			cache_dir = os.path.join(cache_dir, fingerprint.hexdigest())
+			os.makedirs(cache_dir, exist_ok=True)
+		self.cache_dir = cache_dir
+
+		# Texts in batches are always lists, hence they are encoded directly
+		# instead of calling the encoder
 		self.encoder = encoder
+		self.preprocessor = encoder.preprocessor
+		self.generate_encodings = encoder.generate_encodings
 		self.batch_size = batch_size
 		self.summary_max_tokens = summary_max_tokens
 		self.shuffle = shuffle
 		self.seed = seed
-		np.random.seed(seed)
+		self.rng = random.Random(seed)
+		self.order = list(range(num_batches))
 		self.it = None
 
 	def __len__(self) -> int:
@@ -85,50 +132,111 @@ class SummarizationDataset:
 
 		encoder = self.encoder
 		cache = self.cache
+		cache_dir = self.cache_dir
 
 		# Check if input is cached
-		if cache[ind]:
+		if cache[ind] is not None:
 			return cache[ind]
+		if cache_dir is not None and \
+			os.path.exists(self.cache_path(ind, 'input_ids')):
+			return self.load_cached(ind)
 		
-		# Encode texts using encoder and summaries using tokenizer
+		# Encode texts using encoder and pad summary encodings as labels
 		text_batches = self.text_batches
 		summary_batches = self.summary_batches
 		texts = text_batches[ind]
-		encodings = encoder(texts)
+		preprocessor = self.preprocessor
+		if preprocessor is not None:
+			texts = preprocessor(texts)
+		encodings = encoder.tokenizer.pad(
+			{'input_ids': self.generate_encodings(
+				texts, encoder.min_tokens, encoder.max_tokens
+			)},
+			return_tensors = 'pt',
+			verbose = False
+		)
 		if summary_batches is not None:
-			tokenizer = encoder.tokenizer
-			summaries = summary_batches[ind]
-			summ_encodings = tokenizer(
-				summaries, padding=True, max_length=self.summary_max_tokens,
-				truncation=True, return_tensors='pt'
-			)['input_ids']
-
-			# Set padding token ids to -100 (ignored id in attention)
-			filt = summ_encodings == tokenizer.pad_token_id
-			summ_encodings[filt] = -100
-			encodings['labels'] = summ_encodings
+			encodings['labels'] = self.pad_labels(summary_batches[ind])
 
 		# Create batch encoding
 		batch_encodings = BatchEncoding(encodings)
 
 		# Save to cache and delete text batch
-		cache[ind] = batch_encodings
-		text_batches[ind] = 0
+		if cache_dir is None:
+			cache[ind] = batch_encodings
+		else:
+			self.save_cached(ind, batch_encodings)
+		text_batches[ind] = None
 		if summary_batches is not None:
-			summary_batches[ind] = 0
+			summary_batches[ind] = None
 
 		return batch_encodings
 
-	def __iter__(self):
+	def pad_labels(
+		self,
+		summ_encodings: list[list[int]]
+	) -> torch.Tensor:
+
+		# Pad with -100 (ignored id in loss) directly, instead of padding
+		# with the padding token and masking it
+		max_len = max(len(encoding) for encoding in summ_encodings)
+		labels = torch.full(
+			(len(summ_encodings), max_len), -100, dtype=torch.long
+		)
+		pad_left = self.encoder.tokenizer.padding_side == 'left'
+		for i, encoding in enumerate(summ_encodings):
+			encoding = torch.tensor(encoding, dtype=torch.long)
+			if pad_left:
+				labels[i, max_len-len(encoding):] = encoding
+			else:
+				labels[i, :len(encoding)] = encoding
+		return labels
+
+	def cache_path(
+		self,
+		ind: int,
+		key: str
+	) -> str:
+		return os.path.join(self.cache_dir, f'{ind}-{key}.npy')
+
+	def save_cached(
+		self,
+		ind: int,
+		batch_encodings: BatchEncoding
+	) -> None:
+
+		# Input ids are saved last, marking the batch as cached
+		# Files are written under a temporary name so that workers never
+		# read a partially written file
+		keys = sorted(batch_encodings, key=lambda key: key == 'input_ids')
+		for key in keys:
+			path = self.cache_path(ind, key)
+			with open(f'{path}.tmp', 'wb') as fp:
+				np.save(fp, batch_encodings[key].numpy())
+			os.replace(f'{path}.tmp', path)
+
+	def load_cached(
+		self,
+		ind: int
+	) -> BatchEncoding:
+
+		# Memory map arrays copy-on-write, tensors share their memory
+		encodings = {}
+		for key in ('input_ids', 'attention_mask', 'labels'):
+			path = self.cache_path(ind, key)
+			if os.path.exists(path):
+				encodings[key] = torch.from_numpy(np.load(path, mmap_mode='c'))
+		return BatchEncoding(encodings)
+
+	def shuffle_order(self) -> list[int]:
 
-		# Shuffle batches if specified
+		# Shuffle order of batches in place if specified
 		if self.shuffle:
-			permutation = np.random.permutation(self.num_batches)
-			self.text_batches = self.text_batches[permutation]
-			self.cache = self.cache[permutation]
-			if self.summary_batches is not None:
-				self.summary_batches = self.summary_batches[permutation]
+			self.rng.shuffle(self.order)
+		return self.order
 
+	def __iter__(self):
+		self.shuffle_order()
 		self.it = 0
 		return self
 
@@ -143,7 +251,96 @@ class SummarizationDataset:
 			raise StopIteration()
 
 		self.it += 1
-		return self[it]
+		return self[self.order[it]]
+
+
+
+class BatchOrderSampler(Sampler[int]):
+	'''
+	Samples batch indices of a dataset in its order of batches, shuffled
+	every epoch if the dataset shuffles.
+
+	## Parameters
+	`dataset`: Dataset to sample batch indices of
+	'''
+
+	def __init__(
+		self,
+		dataset: SummarizationDataset
+	) -> None:
+		self.dataset = dataset
+
+	def __len__(self) -> int:
+		return len(self.dataset)
+
+	def __iter__(self):
+		return iter(self.dataset.shuffle_order())
+
+
+
+class CudaPrefetcher:
+	'''
+	Iterates over batches and copies them to a CUDA device on a separate
+	stream, so that the copy of the next batch overlaps the current step.
+
+	## Parameters
+	`loader`: Iterable of batches of tensors
+	`device`: CUDA device to copy batches to
+	'''
+
+	def __init__(
+		self,
+		loader: DataLoader,
+		device: str | torch.device
+	) -> None:
+
+		self.loader = loader
+		self.device = device
+		self.stream = torch.cuda.Stream(device)
+		self.batches = None
+		self.next_batch = None
+
+	def __len__(self) -> int:
+		return len(self.loader)
+
+	def __iter__(self):
+		self.batches = iter(self.loader)
+		self.preload()
+		return self
+
+	def __next__(self) -> dict[str, torch.Tensor]:
+
+		# Check if iterator is initialized
+		assert self.batches is not None, 'Iterator not initialized'
+
+		# Check if iterations are completed
+		batch = self.next_batch
+		if batch is None:
+			raise StopIteration()
+
+		# Wait for the copy and mark tensors as used by the compute stream
+		current_stream = torch.cuda.current_stream(self.device)
+		current_stream.wait_stream(self.stream)
+		for value in batch.values():
+			value.record_stream(current_stream)
+
+		self.preload()
+		return batch
+
+	def preload(self) -> None:
+
+		try:
+			batch = next(self.batches)
+		except StopIteration:
+			self.next_batch = None
+			return
+
+		# Copy batch asynchronously on the side stream
+		with torch.cuda.stream(self.stream):
+			self.next_batch = {
+				key: value.to(self.device, non_blocking=True)
+				for key, value in batch.items()
+			}
 	
 
 
@@ -155,29 +352,103 @@ def train_model(
 	scheduler: torch.optim.lr_scheduler.LRScheduler | None = None,
 	device: str | torch.device = 'cpu',
 	flt_prec: int = 4,
-	spaces: int = 100
+	spaces: int = 100,
+	num_workers: int = 0,
+	precision: str = 'bf16',
+	print_interval: float = .1,
+	compile_model: bool = False
 ) -> list[int]:
 
 	model = model.to(device)
 	epoch_losses = []
 	num_batches = len(dataset)
 
+	# Encode batches in worker processes while the model trains
+	# Batches are created by the dataset, hence automatic batching is disabled
+	# Every worker has its own copy of the dataset, hence batches are cached
+	# on disk to be encoded only once and shared by all workers
+	assert num_workers == 0 or dataset.cache_dir is not None, \
+		'Dataset must cache on disk when using workers'
+	use_cuda = torch.device(device).type == 'cuda'
+	loader = DataLoader(
+		dataset,
+		batch_size = None,
+		# Batches are shuffled by the dataset
+		sampler = BatchOrderSampler(dataset),
+		num_workers = num_workers,
+		pin_memory = use_cuda,
+		prefetch_factor = 2 if num_workers else None,
+		persistent_workers = num_workers > 0
+	)
+
+	# Copy the next batch to the GPU while the current batch is trained on
+	batches = CudaPrefetcher(loader, device) if use_cuda else loader
+
+	# Use mixed precision on CUDA devices, falling back to float16 if
+	# bfloat16 is not supported
+	# Loss is scaled with float16 to avoid underflow of gradients
+	assert precision in ('fp32', 'fp16', 'bf16'), \
+		f'Invalid precision: {precision}'
+	use_amp = use_cuda and precision != 'fp32'
+	if use_amp and precision == 'bf16' and not torch.cuda.is_bf16_supported():
+		precision = 'fp16'
+	amp_dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+	scaler = torch.amp.GradScaler(
+		'cuda', enabled = use_amp and precision == 'fp16'
+	)
+	if use_cuda:
+		torch.backends.cuda.matmul.allow_tf32 = True
+
 	model.train(True)
+
+	# Compile model on CUDA devices
+	# Batch shapes vary, hence the model is compiled with dynamic shapes
+	# instead of CUDA graphs, which are recorded again for every shape
+	# Compilation is triggered with the first batch before training, without
+	# updating weights, so that most of it is not included in batch times
+	# The batch is taken from the dataset directly to leave the order of
+	# batches unchanged
+	if compile_model and use_cuda:
+		model = torch.compile(model, dynamic=True)
+		try:
+			inputs = {
+				key: value.to(device)
+				for key, value in dataset[0].items()
+			}
+			with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+				loss = model(**inputs).loss
+			loss.backward()
+			optimizer.zero_grad(set_to_none=True)
+
+		except Exception as e:
+			show_exception(e)
+			print('Training terminated')
+			model.train(False)
+			return epoch_losses, False
+
 	for epoch in range(epochs):
 
-		# Track total epoch loss and time
-		epoch_loss = 0
+		# Track total epoch loss (on device to avoid syncing every batch)
+		# and time
+		epoch_loss = torch.zeros((), device=device)
 		epoch_time = 0
+		last_print = 0.
 
-		for batch, inputs in enumerate(dataset):
+		for batch, inputs in enumerate(batches):
 
 			try:
 				start = time.perf_counter()
-				inputs = inputs.to(device)
-				loss = model(**inputs).loss
-				optimizer.zero_grad()
-				loss.backward()
-				optimizer.step()
+				if not use_cuda:
+					inputs = {
+						key: value.to(device)
+						for key, value in inputs.items()
+					}
+				optimizer.zero_grad(set_to_none=True)
+				with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+					loss = model(**inputs).loss
+				scaler.scale(loss).backward()
+				scaler.step(optimizer)
+				scaler.update()
 				time_taken = (time.perf_counter() - start) * 1000
 
 			except Exception as e:
@@ -186,9 +457,15 @@ def train_model(
 				model.train(False)
 				return epoch_losses, False
 
-			epoch_loss += loss.item()
+			epoch_loss += loss.detach()
 			epoch_time += time_taken
 
+			# Print progress at most once every `print_interval` seconds
+			now = time.perf_counter()
+			if now - last_print < print_interval and batch + 1 < num_batches:
+				continue
+			last_print = now
+
 			# Calculate remaining time
 			seconds = int(
 				epoch_time * (num_batches * (epochs - epoch) / (batch + 1) - 1)
@@ -215,7 +492,7 @@ def train_model(
 				end = None
 			)
 
-		epoch_loss = epoch_loss / num_batches
+		epoch_loss = epoch_loss.item() / num_batches
 		epoch_time = epoch_time / num_batches
 		epoch_losses.append(epoch_loss)
 